@@ -63,11 +63,16 @@ def persistence_diagrams_of_activations(
             list of persistence diagrams of activations
             of the different layers
     """
-    if homology_dimensions is not None:
+    if homology_dimensions is None:
         homology_dimensions = [0, 1]
-    for i, activ in enumerate(activations_list):
-        if len(activ.shape) > 2:  # in case of non FF layers
-            activations_list[i] = activ.view(activ.shape[0], -1)
+    # the activations of non FF layers are flattened and all of them
+    # are converted to numpy only once, without modifying the input list
+    activations_list_array = _convert_list_of_tensor_to_numpy(
+        [
+            activ.reshape(activ.shape[0], -1) if len(activ.shape) > 2 else activ
+            for activ in activations_list
+        ]
+    )
 
     if k > 0 and mode == "VR":
         vr = VietorisRipsPersistence(
@@ -95,11 +100,9 @@ def persistence_diagrams_of_activations(
         )
 
     if k > 0 and mode == "VR":
-        activations_list_array = _convert_list_of_tensor_to_numpy(activations_list)
         dist_matrix = knn_distance_matrix(activations_list_array, k=k)
         persistence_diagrams = vr.fit_transform(dist_matrix)
     else:
-        activations_list_array = _convert_list_of_tensor_to_numpy(activations_list)
         persistence_diagrams = vr.fit_transform(activations_list_array)
 
     return persistence_diagrams
@@ -132,8 +135,8 @@ def _simplified_persistence_of_activations(
 
 def _convert_list_of_tensor_to_numpy(input_list: List[Tensor]) -> List[Array]:
     """private method to convert a list of tensors to a
-    list of arrays"""
+    list of contiguous ``float32`` arrays"""
     output_list: List[Array] = []
     for item in input_list:
-        output_list.append(item.detach().cpu().numpy())
+        output_list.append(numpy.ascontiguousarray(item.detach().cpu().float().numpy()))
     return output_list
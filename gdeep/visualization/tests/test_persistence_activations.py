@@ -0,0 +1,28 @@
+import numpy as np
+import torch
+
+from gdeep.visualization import persistence_diagrams_of_activations
+
+
+def test_persistence_diagrams_of_activations_flattens():
+    torch.manual_seed(0)
+    activ_3d = torch.rand(20, 2, 3)
+    activations = [activ_3d, torch.rand(20, 4)]
+    diagrams = persistence_diagrams_of_activations(activations, k=3)
+    # the input list is left untouched
+    assert activations[0] is activ_3d
+    assert activations[0].shape == (20, 2, 3)
+    # the 3D activations are flattened to (n_points, n_features)
+    flat_diagrams = persistence_diagrams_of_activations(
+        [activ_3d.reshape(20, -1), activations[1]], k=3
+    )
+    assert np.array_equal(diagrams, flat_diagrams)
+
+
+def test_persistence_diagrams_of_activations_homology_dimensions():
+    activations = [torch.rand(20, 3), torch.rand(20, 4)]
+    diagrams = persistence_diagrams_of_activations(
+        activations, homology_dimensions=[0], k=3
+    )
+    # the third column of each diagram is the homology dimension
+    assert set(np.unique(diagrams[:, :, 2])) == {0.0}
@@ -0,0 +1,18 @@
+import io
+
+from PIL import Image
+
+from gdeep.visualization import plotly2tensor
+from gdeep.visualization import utils
+
+
+def test_plotly2tensor(monkeypatch):
+    def fake_to_image(fig, format):
+        buffer = io.BytesIO()
+        Image.new("RGB", (7, 5), color=(255, 0, 0)).save(buffer, format=format)
+        return buffer.getvalue()
+
+    # the rendering engine is replaced: only the decoding is tested
+    monkeypatch.setattr(utils, "to_image", fake_to_image)
+    img_t = plotly2tensor(None)
+    assert img_t.shape == (5, 7, 3)
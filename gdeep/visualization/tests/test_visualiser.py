@@ -1,42 +1,54 @@
+import numpy as np
+import pytest
 import torch
 import torch.nn as nn
+from torch.optim import SGD
 from torch.utils.data.sampler import SubsetRandomSampler
 from torch.utils.tensorboard.writer import SummaryWriter
 
 from gdeep.data.preprocessors import TokenizerTextClassification
-from gdeep.data.datasets import DataLoaderBuilder, DatasetBuilder
+from gdeep.data.datasets import DataLoaderBuilder, DatasetBuilder, FromArray
+from gdeep.models import FFNet
 from gdeep.trainer import Trainer
 from gdeep.utility import DEVICE
-from gdeep.visualization import Visualiser
+from gdeep.visualization import Visualiser, persistence_diagrams_of_activations
 
 
-bd = DatasetBuilder(name="AG_NEWS", convert_to_map_dataset=True)
-ds_tr_str, ds_val_str, ds_ts_str = bd.build()
+@pytest.fixture(scope="session")
+def text_pipe():
+    """build the AG_NEWS dataloaders once per test session"""
+    bd = DatasetBuilder(name="AG_NEWS", convert_to_map_dataset=True)
+    ds_tr_str, ds_val_str, ds_ts_str = bd.build()
 
+    ptd = TokenizerTextClassification()
 
-ptd = TokenizerTextClassification()
+    ptd.fit_to_dataset(ds_tr_str)
+    transformed_textds = ptd.attach_transform_to_dataset(ds_tr_str)  # type: ignore
+    transformed_textts = ptd.attach_transform_to_dataset(ds_val_str)  # type: ignore
 
-ptd.fit_to_dataset(ds_tr_str)
-transformed_textds = ptd.attach_transform_to_dataset(ds_tr_str)  # type: ignore
-transformed_textts = ptd.attach_transform_to_dataset(ds_val_str)  # type: ignore
+    # the only part of the training/test set we are interested in
+    train_indices = list(range(64 * 10))
+    test_indices = list(range(64 * 5))
 
-# the only part of the training/test set we are interested in
-train_indices = list(range(64 * 10))
-test_indices = list(range(64 * 5))
-
-dl_tr2, dl_ts2, _ = DataLoaderBuilder([transformed_textds, transformed_textts]).build(
-    [
-        {"batch_size": 16, "sampler": SubsetRandomSampler(train_indices)},
-        {"batch_size": 16, "sampler": SubsetRandomSampler(test_indices)},
-    ]
-)
-writer = SummaryWriter()
+    dl_tr2, dl_ts2, _ = DataLoaderBuilder(
+        [transformed_textds, transformed_textts]
+    ).build(
+        [
+            {"batch_size": 16, "sampler": SubsetRandomSampler(train_indices)},
+            {"batch_size": 16, "sampler": SubsetRandomSampler(test_indices)},
+        ]
+    )
+    writer = SummaryWriter()
+    yield ptd, dl_tr2, dl_ts2, writer
+    writer.close()
 
 
 class TextClassificationModel(nn.Module):
     def __init__(self, vocab_size, embed_dim, num_class):
         super(TextClassificationModel, self).__init__()
-        self.embedding = nn.Embedding(vocab_size, embed_dim, sparse=True)
+        self.embedding = nn.EmbeddingBag(
+            vocab_size, embed_dim, mode="mean", sparse=True
+        )
         self.fc = nn.Linear(embed_dim, num_class)
         self.init_weights()
 
@@ -47,12 +59,13 @@ class TextClassificationModel(nn.Module):
         self.fc.bias.data.zero_()
 
     def forward(self, text):
-        embedded = self.embedding(text)
-        mean = torch.mean(embedded, dim=1)
+        # each row of ``text`` is a bag: the mean is fused in the lookup
+        mean = self.embedding(text)
         return self.fc(mean)
 
 
-def test_visualiser():
+def test_visualiser(text_pipe):
+    ptd, dl_tr2, dl_ts2, writer = text_pipe
     assert ptd.vocabulary is not None, "vocabulary is None"
     vocab_size = len(ptd.vocabulary)
     embedding_size = 64
@@ -70,3 +83,128 @@ def test_visualiser():
     vs.plot_betti_surface_layers([0, 1], x)
     vs.plot_betti_curves_layers([0, 1], x)
     vs.plot_betti_numbers_layers(batch=x, filtration_value=0.3)
+
+
+@pytest.fixture()
+def array_pipe(tmp_path):
+    """a small trainer on random tabular data"""
+    X = np.array(np.random.rand(40, 4), dtype=np.float32)
+    y = np.array(np.random.randint(2, size=40), dtype=np.int64)
+    dl_tr, *_ = DataLoaderBuilder([FromArray(X, y)]).build([{"batch_size": 20}])
+    model = FFNet(arch=(4, 5, 2)).to(DEVICE)
+    writer = SummaryWriter(log_dir=str(tmp_path))
+    return Trainer(model, [dl_tr, None], nn.CrossEntropyLoss(), writer)  # type: ignore
+
+
+def test_activations_cache(array_pipe):
+    vs = Visualiser(array_pipe)
+    inputs, labels = vs._collect_inputs()
+    acts = vs._get_activations(inputs)
+    # same inputs and same model: the cached activations are returned
+    assert all(a is b for a, b in zip(acts, vs._get_activations(inputs)))
+
+    # an optimizer step updates the parameters in place
+    optimizer = SGD(array_pipe.model.parameters(), lr=0.1)
+    array_pipe.loss_fn(
+        array_pipe.model(inputs.to(DEVICE)), labels.to(DEVICE)
+    ).backward()
+    optimizer.step()
+    new_acts = vs._get_activations(inputs)
+    assert not any(a is b for a, b in zip(acts, new_acts))
+
+
+def test_plot_3d_dataset(array_pipe, monkeypatch):
+    logged = {}
+    monkeypatch.setattr(
+        array_pipe.writer,
+        "add_embedding",
+        lambda mat, metadata, **kwargs: logged.update(mat=mat, metadata=metadata),
+    )
+    Visualiser(array_pipe).plot_3d_dataset(n_pts=30)
+    # the points are the first 30 items of the dataloader, two batches
+    expected = torch.cat([x for x, _ in array_pipe.dataloaders[0]])[:30]
+    assert torch.equal(logged["mat"].cpu(), expected)
+    assert len(logged["metadata"]) == 30
+
+
+def _adjust_tensors_to_plot_reference(tensor):
+    """the original implementation of ``_adjust_tensors_to_plot``"""
+    list_of_permutation = torch.argsort(torch.tensor(tensor.shape)).tolist()
+    list_of_permutation.reverse()
+    tensor = tensor.permute(*list_of_permutation)
+    if tensor.shape[-1] == 2:
+        temporary = torch.zeros((tensor.shape[0], tensor.shape[1], 3))
+        temporary[:, :, :2] = tensor
+        tensor = temporary
+    else:
+        tensor = tensor[:, :, :4]
+    return tensor.permute(1, 0, 2).cpu().detach().numpy()
+
+
+@pytest.mark.parametrize("shape", [(3, 28, 28), (3, 20, 30), (2, 16, 16), (2, 12, 18)])
+def test_adjust_tensors_to_plot(shape):
+    tensor = torch.rand(shape)
+    output = Visualiser._adjust_tensors_to_plot(tensor)
+    expected = _adjust_tensors_to_plot_reference(tensor)
+    assert output.dtype == expected.dtype
+    assert np.array_equal(output, expected)
+
+
+def test_get_betti_curves(array_pipe):
+    vs = Visualiser(array_pipe)
+    inputs, _ = vs._collect_inputs()
+    vs.persistence_diagrams = persistence_diagrams_of_activations(
+        vs._get_activations(inputs), k=3
+    )
+    bc, curves = vs._get_betti_curves()
+    # the curves are reused as long as the diagrams do not change
+    assert vs._get_betti_curves()[1] is curves
+    vs.persistence_diagrams = persistence_diagrams_of_activations(
+        vs._get_activations(inputs), k=4
+    )
+    new_bc, new_curves = vs._get_betti_curves()
+    assert new_bc is not bc and new_curves is not curves
+
+
+def test_get_activations_inference(array_pipe):
+    vs = Visualiser(array_pipe)
+    inputs, _ = vs._collect_inputs()
+    for act in vs._get_activations(inputs):
+        assert act.dtype == torch.float32
+        assert not act.requires_grad and act.grad_fn is None
+
+
+@pytest.mark.skipif(not hasattr(torch, "compile"), reason="needs torch.compile")
+def test_compile_model(array_pipe):
+    vs = Visualiser(array_pipe, compile_model=True)
+    compiled = vs._forward_model()
+    assert compiled is not array_pipe.model
+    assert vs._forward_model() is compiled
+    inputs, _ = vs._collect_inputs()
+    inputs = inputs.to(DEVICE)
+    with torch.no_grad():
+        assert torch.allclose(compiled(inputs), array_pipe.model(inputs))
+    # a new model is compiled again
+    array_pipe.model = FFNet(arch=(4, 5, 2)).to(DEVICE)
+    assert vs._forward_model() is not compiled
+
+
+def test_plot_betti_surface_layers(array_pipe):
+    # the figures are only returned: no image engine is needed
+    plots = Visualiser(array_pipe).plot_betti_surface_layers([0, 1], k=3)
+    assert len(plots) == 2
+
+
+def test_plot_interactive_model(array_pipe, monkeypatch):
+    graphs = []
+    monkeypatch.setattr(
+        array_pipe.writer, "add_graph", lambda model, x: graphs.append(model)
+    )
+    vs = Visualiser(array_pipe)
+    vs.plot_interactive_model()
+    vs.plot_interactive_model()
+    assert graphs == [array_pipe.model]
+    # the graph of a new model is logged again
+    array_pipe.model = FFNet(arch=(4, 5, 2)).to(DEVICE)
+    vs.plot_interactive_model()
+    assert graphs[-1] is array_pipe.model and len(graphs) == 2
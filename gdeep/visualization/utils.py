@@ -1,9 +1,9 @@
+import io
 import os
-import time
 
 from PIL import Image
 import numpy as np
-from plotly.io import write_image
+from plotly.io import to_image
 import torch
 
 
@@ -19,14 +19,10 @@ def plotly2tensor(fig) -> torch.Tensor:
             the tensor discretisation of the
             figure
     """
-    now = str(time.time()).replace(".", "-")
-    try:
-        write_image(fig, "deleteme" + now + ".jpeg", format="jpeg", engine="orca")
-    except ValueError:
-        write_image(fig, "deleteme" + now + ".jpeg", format="jpeg")
-    with Image.open("deleteme" + now + ".jpeg") as img:
+    # the image is rendered in memory, without temporary files
+    img_bytes = to_image(fig, format="jpeg")
+    with Image.open(io.BytesIO(img_bytes)) as img:
         arr = np.asarray(img).copy()  # type: ignore
-    os.remove("deleteme" + now + ".jpeg")
     return torch.from_numpy(arr)
 
 
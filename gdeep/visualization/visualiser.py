@@ -1,9 +1,10 @@
 from typing import List, Optional, Union, Tuple, Any
-import random
 from copy import copy
 import warnings
+import weakref
 
 import torch
+import torch.nn.functional as F
 from torchvision.utils import make_grid
 from sklearn.manifold import MDS
 from gtda.diagrams import BettiCurve
@@ -40,6 +41,12 @@ class Visualiser:
     Args:
         pipe :
             the Trainer instance to get info from
+        compile_model :
+            if ``True`` and ``torch.compile`` is available,
+            the repeated forward passes of the decision
+            boundary computations use a compiled copy of
+            the model. The hook-based methods, like
+            ``plot_activations``, always use the eager model
 
     Examples::
 
@@ -52,27 +59,119 @@ class Visualiser:
 
     persistence_diagrams: Optional[List[Array]] = None
 
-    def __init__(self, pipe: Trainer) -> None:
+    def __init__(self, pipe: Trainer, compile_model: bool = False) -> None:
         self.pipe = pipe
+        self._cached_activations: Optional[
+            Tuple[Any, Tuple[Any, ...], List[Tensor]]
+        ] = None
+        self._first_batch: Optional[Any] = None
+        self._betti: Optional[Tuple[Any, BettiCurve, Array]] = None
+        # weak reference to the last model whose graph was sent to
+        # tensorboard: unlike its id, it cannot match a new model
+        self._graph_logged: Optional[weakref.ref] = None
+        self._compile_model = compile_model and hasattr(torch, "compile")
+        # the id of the compiled ``self.pipe.model`` and its compiled version
+        self._compiled_model: Optional[Tuple[int, torch.nn.Module]] = None
+
+    def _forward_model(self) -> torch.nn.Module:
+        """private method returning the compiled ``self.pipe.model``
+        if ``compile_model`` was set, and ``self.pipe.model`` otherwise.
+        The model is compiled lazily, and again if it is replaced."""
+        if not self._compile_model:
+            return self.pipe.model
+        if self._compiled_model is None or self._compiled_model[0] != id(
+            self.pipe.model
+        ):
+            self._compiled_model = (
+                id(self.pipe.model),
+                torch.compile(self.pipe.model),  # type: ignore
+            )
+        return self._compiled_model[1]
+
+    def _get_first_batch(self) -> Any:
+        """private method to get the first batch of the training
+        dataloader. The batch is stored, so that the dataloader
+        is not iterated (and the collate function not run) again
+        by each plotting method."""
+        if self._first_batch is None:
+            self._first_batch = next(iter(self.pipe.dataloaders[0]))
+        return self._first_batch
+
+    def _collect_inputs(self, batch: Optional[Any] = None) -> Tuple[Any, Any]:
+        """private method to get the inputs and the labels of ``batch``.
+        If ``batch`` is ``None``, the first batch of the training
+        dataloader is used."""
+        if batch is not None:
+            inputs, labels = batch
+        else:
+            inputs, labels = self._get_first_batch()
+        return inputs, labels
+
+    def _model_state(self) -> Tuple[Any, ...]:
+        """private method returning a key that changes whenever
+        ``self.pipe.model`` is replaced or any of its parameters
+        is updated in place, like an optimizer step does"""
+        return (id(self.pipe.model),) + tuple(
+            param._version for param in self.pipe.model.parameters()
+        )
+
+    def _get_activations(self, inputs: Union[Tensor, List[Tensor]]) -> List[Tensor]:
+        """private method to compute the activations of all the
+        layers of ``self.pipe.model``. Only the forward pass is needed,
+        hence autograd is disabled and, on GPUs supporting it, the
+        pass is run in ``bfloat16`` mixed precision. The activations are returned
+        in ``float32`` and cached: calling this method again with
+        the same ``inputs`` object does not run the model again,
+        unless the model or its parameters have changed in between
+        (e.g. because of further training)."""
+        model_state = self._model_state()
+        if (
+            self._cached_activations is not None
+            and self._cached_activations[0] is inputs
+            and self._cached_activations[1] == model_state
+        ):
+            return list(self._cached_activations[2])
+        me = ModelExtractor(self.pipe.model, self.pipe.loss_fn)
+        with torch.inference_mode(), torch.autocast(
+            device_type=DEVICE.type,
+            dtype=torch.bfloat16,
+            enabled=DEVICE.type == "cuda" and torch.cuda.is_bf16_supported(),
+        ):
+            acts = me.get_activations(inputs)
+        acts = [act.float() for act in acts]
+        self._cached_activations = (inputs, model_state, acts)
+        return list(acts)
+
+    def _get_betti_curves(self) -> Tuple[BettiCurve, Array]:
+        """private method to compute the Betti curves of
+        ``self.persistence_diagrams``. The result is stored and
+        reused as long as the persistence diagrams do not change."""
+        if self._betti is None or self._betti[0] is not self.persistence_diagrams:
+            bc = BettiCurve()
+            curves = bc.fit_transform(self.persistence_diagrams)
+            self._betti = (self.persistence_diagrams, bc, curves)
+        return self._betti[1], self._betti[2]
 
     def plot_interactive_model(self) -> None:
         """This function has no arguments: its purpose
         is to store the model to tensorboard for an
-        interactive visualization.
+        interactive visualization. The graph of a given
+        model is traced and stored only once.
         """
-
-        data_iter = iter(self.pipe.dataloaders[0])
-        x, _ = next(data_iter)
+        if self._graph_logged is not None and self._graph_logged() is self.pipe.model:
+            return
+        x, _ = self._get_first_batch()
         new_x: List[Tensor] = []
         if isinstance(x, tuple) or isinstance(x, list):
             for i, xi in enumerate(x):
-                new_x.append(xi.to(DEVICE))
+                new_x.append(xi.to(DEVICE, non_blocking=True))
             x = copy(new_x)
         else:
-            x = x.to(DEVICE)
+            x = x.to(DEVICE, non_blocking=True)
         # add interactive model to tensorboard
         self.pipe.writer.add_graph(self.pipe.model, x)  # type: ignore
         self.pipe.writer.flush()  # type: ignore
+        self._graph_logged = weakref.ref(self.pipe.model)
 
     def plot_3d_dataset(self, n_pts: int = 100) -> None:
         """This function has no arguments: its purpose
@@ -85,14 +184,30 @@ class Visualiser:
                 number of points to display
         """
         data_iter = iter(self.pipe.dataloaders[0])
-        features_list: List[Tensor] = []
+        buffer: Optional[Tensor] = None
         labels_list: List[str] = []
+        max_number = 0  # effective number of points
 
         for img, lab in data_iter:  # loop over batches
             if isinstance(img, tuple) or isinstance(img, list):
-                features_list = features_list + [img[i][0] for i in range(len(img))]
+                items = [img[i][0] for i in range(len(img))]
             else:
-                features_list = features_list + [img[i] for i in range(len(img))]
+                items = img
+            if buffer is None:
+                # preallocate the host buffer once, pinned to allow
+                # an asynchronous copy to the GPU
+                buffer = torch.empty(
+                    (n_pts,) + tuple(items[0].shape),
+                    dtype=items[0].dtype,
+                    pin_memory=DEVICE.type == "cuda",
+                )
+            n_new = min(len(items), n_pts - max_number)
+            if isinstance(items, list):
+                for i in range(n_new):
+                    buffer[max_number + i].copy_(items[i])
+            else:  # one copy for the whole batch
+                buffer[max_number : max_number + n_new].copy_(items[:n_new])
+            max_number += n_new
             try:
                 labels_list = labels_list + [
                     str(lab[i].item()) for i in range(len(lab))
@@ -101,20 +216,15 @@ class Visualiser:
                 labels_list = labels_list + [
                     "Label not available" for _ in range(len(img))
                 ]
-            if len(features_list) >= n_pts:
+            if max_number >= n_pts:
                 break
-        max_number = len(features_list)  # effective number of points
+        assert buffer is not None, "The dataloader is empty"
+        labels_list = labels_list[:max_number]
 
-        features = torch.cat(features_list).to(DEVICE)
+        features = buffer[:max_number].to(DEVICE, non_blocking=True)
 
-        if len(features.shape) >= 3:
-            if len(features.shape) == 3:
-                features = features.reshape(
-                    max_number, -1, features.shape[1], features.shape[2]
-                )
-                grid = make_grid(features)
-            else:
-                grid = make_grid(features)
+        if len(features.shape) >= 4:
+            grid = make_grid(features.flatten(0, -4))
 
             self.pipe.writer.add_image("dataset", grid, 0)  # type: ignore
 
@@ -145,13 +255,8 @@ class Visualiser:
             batch:
                 this should be an input batch for the model
         """
-        me = ModelExtractor(self.pipe.model, self.pipe.loss_fn)
-        if batch is not None:
-            inputs, labels = batch
-        else:
-            inputs, labels = next(iter(self.pipe.dataloaders[0]))
-
-        acts = me.get_activations(inputs)
+        inputs, labels = self._collect_inputs(batch)
+        acts = self._get_activations(inputs)
         print("Sending the plots to tensorboard: ")
         for i, act in enumerate(acts):
             print("Step " + str(i + 1) + "/" + str(len(acts)), end="\r")
@@ -183,19 +288,14 @@ class Visualiser:
 
         if homology_dimensions is None:
             homology_dimensions = [0, 1]
-        me = ModelExtractor(self.pipe.model, self.pipe.loss_fn)
         if self.persistence_diagrams is None:
-            if batch is not None:
-                inputs, _ = batch
-            else:
-                inputs, _ = next(iter(self.pipe.dataloaders[0]))
-
-            activation = me.get_activations(inputs)
+            inputs, _ = self._collect_inputs(batch)
+            activation = self._get_activations(inputs)
             self.persistence_diagrams = persistence_diagrams_of_activations(
                 activation, homology_dimensions=homology_dimensions, **kwargs
             )
         list_of_dgms = []
-        for i, persistence_diagram in enumerate(self.persistence_diagrams):
+        for persistence_diagram in self.persistence_diagrams:
             plot_persistence_diagram = plot_diagram(persistence_diagram)
             img_t = plotly2tensor(plot_persistence_diagram)
             list_of_dgms.append(img_t)
@@ -230,13 +330,13 @@ class Visualiser:
 
         """
 
-        me = ModelExtractor(self.pipe.model, self.pipe.loss_fn)
-        x = next(iter(self.pipe.dataloaders[0]))[0][0]
+        me = ModelExtractor(self._forward_model(), self.pipe.loss_fn)
+        x = self._get_first_batch()[0][0]
 
         if compact:
             # initialization of the compactification
             cc = Compactification(
-                neural_net=self.pipe.model,
+                neural_net=self._forward_model(),
                 precision=0.1,
                 n_samples=500,
                 epsilon=0.051,
@@ -245,7 +345,7 @@ class Visualiser:
             )
 
             d_final, label_final = cc.create_final_distance_matrix()
-            embedding = MDS(n_components=3, dissimilarity="precomputed")
+            embedding = MDS(n_components=3, dissimilarity="precomputed", n_jobs=-1)
             db = embedding.fit_transform(d_final)
             self.pipe.writer.add_embedding(  # type: ignore
                 db, tag="compactified_decision_boundary", global_step=0
@@ -285,18 +385,13 @@ class Visualiser:
         if homology_dimensions is None:
             homology_dimensions = [0, 1]
         if self.persistence_diagrams is None:
-            me = ModelExtractor(self.pipe.model, self.pipe.loss_fn)
-            if batch is not None:
-                inputs, _ = batch
-            else:
-                inputs = next(iter(self.pipe.dataloaders[0]))  # type: ignore
+            inputs, _ = self._collect_inputs(batch)
             self.persistence_diagrams = persistence_diagrams_of_activations(
-                me.get_activations(inputs),
+                self._get_activations(inputs),
                 homology_dimensions=homology_dimensions,
                 **kwargs
             )
-        bc = BettiCurve()
-        dgms = bc.fit_transform(self.persistence_diagrams)
+        bc, dgms = self._get_betti_curves()
 
         plots = plot_betti_surfaces(
             dgms, samplings=bc.samplings_, homology_dimensions=homology_dimensions
@@ -328,18 +423,13 @@ class Visualiser:
         if homology_dimensions is None:
             homology_dimensions = [0, 1]
         if self.persistence_diagrams is None:
-            me = ModelExtractor(self.pipe.model, self.pipe.loss_fn)
-            if batch is not None:
-                inputs, _ = batch
-            else:
-                inputs = next(iter(self.pipe.dataloaders[0]))  # type: ignore
+            inputs, _ = self._collect_inputs(batch)
             self.persistence_diagrams = persistence_diagrams_of_activations(
-                me.get_activations(inputs),
+                self._get_activations(inputs),
                 homology_dimensions=homology_dimensions,
                 **kwargs
             )
-        bc = BettiCurve()
-        bc_curves = bc.fit_transform(self.persistence_diagrams)
+        bc, bc_curves = self._get_betti_curves()
         list_of_plts = []
         for bc_curve in bc_curves:
             plots = plot_betti_curves(
@@ -390,11 +480,8 @@ class Visualiser:
         """
 
         try:
-            attrib = (
-                torch.permute(interpreter.attribution.squeeze().detach(), (1, 2, 0))
-                .detach()
-                .cpu()
-                .numpy()
+            attrib = torch.permute(
+                interpreter.attribution.squeeze().detach(), (1, 2, 0)
             )
         except ValueError:
             attrib = torch.permute(
@@ -404,13 +491,9 @@ class Visualiser:
                 ).squeeze(0),
                 (1, 2, 0),
             )
-            attrib = (
-                torch.stack([attrib, attrib, attrib], dim=2)
-                .squeeze(-1)
-                .detach()
-                .cpu()
-                .numpy()
-            )
+            # the single channel is broadcast to RGB as a view, without copies
+            attrib = attrib.expand(-1, -1, 3)
+        attrib = attrib.cpu().numpy()
         img = (
             torch.permute(interpreter.x.squeeze().detach(), (1, 2, 0))
             .detach()
@@ -461,20 +544,27 @@ class Visualiser:
         plt.rc("axes", titlesize=FONT_SIZE)  # fontsize of the axes title
         plt.rc("axes", labelsize=FONT_SIZE)  # fontsize of the x and y labels
         plt.rc("legend", fontsize=FONT_SIZE - 4)  # fontsize of the legend
-        for i in range(len(interpreter.attribution_list)):  # type: ignore
-            attribution_sum = interpreter.attribution_list[i].detach().cpu().numpy().sum(0)  # type: ignore
-            attribution_norm_sum = attribution_sum / np.linalg.norm(
-                attribution_sum, ord=1
-            )
-            r = lambda: random.randint(0, 255)  # noqa
-            color = "#%02X%02X%02X" % (r(), r(), r())
+        # a single device-to-host copy and a vectorised L1 normalisation
+        # of the summed attributions, of shape (n_attributions, n_features)
+        attribution_sums = (
+            torch.stack([attr.detach() for attr in interpreter.attribution_list])  # type: ignore
+            .sum(1)
+            .cpu()
+            .numpy()
+        )
+        attribution_norm_sums = attribution_sums / np.abs(attribution_sums).sum(
+            axis=1, keepdims=True
+        )
+        # one random RGB colour per attribution
+        colors = np.random.default_rng().random((len(attribution_norm_sums), 3))
+        for attribution_norm_sum, color in zip(attribution_norm_sums, colors):
             ax.bar(
                 x_axis_data,
                 attribution_norm_sum,
                 width,
                 align="center",
                 alpha=0.8,
-                color=color,
+                color=tuple(color),
             )
 
         ax.autoscale_view()
@@ -625,14 +715,12 @@ class Visualiser:
         if homology_dimensions is None:
             homology_dimensions = [0, 1]
 
-        me = ModelExtractor(self.pipe.model, self.pipe.loss_fn)
-        if batch is not None:
-            inputs, _ = batch
-        else:
-            inputs = next(iter(self.pipe.dataloaders[0]))  # type: ignore
-
+        inputs, _ = self._collect_inputs(batch)
         simplified_persistence_diagrams = _simplified_persistence_of_activations(
-            me.get_activations(inputs), homology_dimensions, filtration_value, **kwargs
+            self._get_activations(inputs),
+            homology_dimensions,
+            filtration_value,
+            **kwargs
         )
 
         betti_numbers = []
@@ -667,14 +755,16 @@ class Visualiser:
             tensor = tensor[0, :, :, :]
         elif len(tensor.shape) > 4:
             tensor = tensor[0, :, :, :, 0]
-        list_of_permutation = torch.argsort(torch.tensor(tensor.shape)).tolist()
-        list_of_permutation.reverse()
+        # dimensions sorted by decreasing size, the later
+        # dimension first in case of ties (e.g. square images)
+        list_of_permutation = sorted(
+            range(tensor.dim()), key=lambda i: (tensor.shape[i], i), reverse=True
+        )
         tensor = tensor.permute(*list_of_permutation)
 
         if tensor.shape[-1] == 2:
-            temporary = torch.zeros((tensor.shape[0], tensor.shape[1], 3))
-            temporary[:, :, :2] = tensor
-            tensor = temporary
+            # pad the two channels with a zero third one
+            tensor = F.pad(tensor.float(), (0, 1))
         else:
             tensor = tensor[:, :, :4]
         return tensor.permute(1, 0, 2).cpu().detach().numpy()